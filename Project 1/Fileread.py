@@ -1,245 +1,1434 @@
 import csv
+import io
+import json
+import logging
+import math
 import os
+import pickle
+import re
+import sys
+import tempfile
+from array import array
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from decimal import Decimal
+from functools import lru_cache
+from itertools import chain, compress, count, islice, repeat
+from operator import eq, gt, itemgetter, lt, not_
+
+logger = logging.getLogger(__name__)
+
+
+class DictColumn:
+    # Dictionary-encoded text column: int32 codes into the list of distinct
+    # values. Iterating or indexing decodes, so it reads like a list of str.
+    __slots__ = ('codes', 'dictionary', 'index')
+
+    def __init__(self, codes, dictionary, index=None):
+        self.codes = codes
+        self.dictionary = dictionary
+        self.index = index if index is not None else {value: code for code, value in enumerate(dictionary)}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        return map(self.dictionary.__getitem__, self.codes)
+
+    def __getitem__(self, i):
+        return self.dictionary[self.codes[i]]
+
+    def __mul__(self, times):
+        return DictColumn(self.codes * times, self.dictionary, self.index)
+
+    def __reduce__(self):
+        return DictColumn, (self.codes, self.dictionary)
+
+    def __repr__(self):
+        return f"DictColumn({list(self)!r})"
+
+
+# Text columns with more distinct values than this share of their rows stay plain lists
+DICTIONARY_MAX_RATIO = 0.5
+
+
+def _dictionary_encode(values, dictionary=None, index=None):
+    # Encode text values as codes, extending the given dictionary with unseen values
+    dictionary = [] if dictionary is None else dictionary
+    index = {} if index is None else index
+    codes = array('i')
+    for value in values:
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(dictionary)
+            dictionary.append(value)
+        codes.append(code)
+    return DictColumn(codes, dictionary, index)
+
+
+def _infer_column(values):
+    # Store numeric columns as typed arrays, repetitive text as a DictColumn,
+    # and everything else stays a list of str. A column is only typed when
+    # every cell is written back exactly as read: 02134, 2.50, 1e3, 1_000 or
+    # nan, once parsed, would not print as their source text
+    try:
+        ints = array('q', map(int, values))
+        if all(map(eq, map(str, ints), values)):
+            return ints
+    except (ValueError, OverflowError):
+        pass
+    try:
+        floats = array('d', map(float, values))
+        if all(map(math.isfinite, floats)) and all(map(eq, map(repr, floats), values)):
+            return floats
+    except ValueError:
+        pass
+    index = dict.fromkeys(values)
+    if len(index) > DICTIONARY_MAX_RATIO * len(values):
+        return list(values)
+    dictionary = list(index)
+    index = {value: code for code, value in enumerate(dictionary)}
+    return DictColumn(array('i', map(index.__getitem__, values)), dictionary, index)
+
+
+def _kind(column):
+    # Array typecode of numeric columns, 'dict' for encoded text, 'str' otherwise
+    if isinstance(column, array):
+        return column.typecode
+    return 'dict' if isinstance(column, DictColumn) else 'str'
+
+
+# Comparison operators usable in SELE conditions
+OPS = {'>': gt, '<': lt, '=': eq}
+
+
+# Integer columns compare against an integer bound, which is cheaper than
+# mixing int and float per cell: x > 70.5 <=> x > 70 and x < 70.5 <=> x < 71
+INT_BOUNDS = {'>': math.floor, '<': math.ceil}
+
+
+def _cast_constant(operator, kind, value, number):
+    # Pick the form of a condition constant its column compares in, or None
+    # when no cell can match. Equality compares text: the cells of a typed
+    # column print back as their source text, so only a constant written the
+    # same way can equal one (ID = 079 and Payment = 79.0 match nothing).
+    # Ordering compares numbers, exactly on integer columns
+    if operator == '=':
+        if kind in ('str', 'dict'):
+            return value
+        try:
+            constant = int(value) if kind == 'q' else float(value)
+        except ValueError:
+            return None
+        return constant if (str(constant) if kind == 'q' else repr(constant)) == value else None
+    if number is None:
+        raise ValueError(f"Cannot compare with '{value}': not a number.")
+    if kind == 'q' and math.isfinite(number):
+        # int() keeps integers past 2**53 exact, Decimal the bound of 70.5
+        try:
+            return int(value)
+        except ValueError:
+            return INT_BOUNDS[operator](Decimal(value))
+    return number
+
+
+class DictionaryFlags(dict):
+    # Result of one ordering test per dictionary code, cast and compared the
+    # first time a scanned row has that code: like a text column, which only
+    # casts the cells it reaches, an entry such as 'N/A' that no scanned row
+    # holds never raises
+    __slots__ = ('dictionary', 'compare', 'constant')
+
+    def __init__(self, dictionary, operator, value, number):
+        super().__init__()
+        self.dictionary = dictionary
+        self.compare = OPS[operator]
+        self.constant = _cast_constant(operator, 'str', value, number)
+
+    def __missing__(self, code):
+        flag = self[code] = self.compare(float(self.dictionary[code]), self.constant)
+        return flag
+
+
+@lru_cache(maxsize=None)
+def _comparison_kernel(operator, kind):
+    # Build the mask function specialized for one (operator, column kind) once;
+    # kind is one of the _kind() values
+    compare = OPS[operator]
+
+    if kind == 'dict':
+        def kernel(column, value, number):
+            if operator == '=':
+                # Translate the constant to its code once, then compare integers
+                code = column.index.get(value)
+                if code is None:
+                    return [False] * len(column)
+                return list(map(eq, column.codes, repeat(code, len(column))))
+            # Test every distinct value once and look the result up by code
+            return list(map(DictionaryFlags(column.dictionary, operator, value, number).__getitem__, column.codes))
+        return kernel
+
+    # Ordering on a text column compares the cells as numbers
+    cast_cells = kind == 'str' and operator != '='
+
+    def kernel(column, value, number):
+        value = _cast_constant(operator, kind, value, number)
+        if value is None:
+            return [False] * len(column)
+        cells = map(float, column) if cast_cells else column
+        return list(map(compare, cells, repeat(value, len(column))))
+    return kernel
+
+
+SOURCE_OPS = {'>': '>', '<': '<', '=': '=='}
+
+# Codes of a DictColumn handed to a fused kernel, remembering their column
+ColumnCodes = namedtuple('ColumnCodes', ['column'])
+
+
+def _cell_kind(column):
+    # Kind of the cells a fused kernel sees: only ColumnCodes cells are codes,
+    # a bare DictColumn is scanned decoded, as text
+    return 'dict' if isinstance(column, ColumnCodes) else 'str' if isinstance(column, DictColumn) else _kind(column)
+
+
+def _fused_expression(predicate, cells, values):
+    # Python source of a bound condition tree over the cells x<i> of a row;
+    # constants are appended to `values` and referenced as v<k>, so the source
+    # only depends on the shape of the condition and the column types.
+    # `cells` maps positions to the sequence the kernel iterates over.
+    if isinstance(predicate, (And, Or)):
+        joiner = ' and ' if isinstance(predicate, And) else ' or '
+        return '(' + joiner.join(_fused_expression(term, cells, values) for term in predicate.terms) + ')'
+    operator = SOURCE_OPS[predicate.operator]
+    if isinstance(predicate, ColumnComparison):
+        # Both sides are cells of a row: ordering compares them as numbers, and
+        # equality of columns typed differently ('79' next to 79) compares text
+        positions = (predicate.left, predicate.right)
+        kinds = [_cell_kind(cells[position]) for position in positions]
+        if predicate.operator != '=':
+            casts = ['float' if kind == 'str' else '' for kind in kinds]
+        else:
+            casts = ['str' if kinds[0] != kinds[1] else ''] * 2
+        left, right = (f"{cast}(x{position})" for cast, position in zip(casts, positions))
+        return f"({left} {operator} {right})"
+    column = cells[predicate.attr]
+    kind = _cell_kind(column)
+    if kind == 'dict':
+        # Encoded cells are codes: equality compares the constant's code, and
+        # ordering looks up the result of each distinct value a row reaches
+        dictionary = column.column
+        if predicate.operator == '=':
+            constant = dictionary.index.get(predicate.value)
+            if constant is None:
+                return 'False'
+            values.append(constant)
+            return f"(x{predicate.attr} == v{len(values) - 1})"
+        values.append(DictionaryFlags(dictionary.dictionary, predicate.operator, predicate.value, predicate.number))
+        return f"v{len(values) - 1}[x{predicate.attr}]"
+    constant = _cast_constant(predicate.operator, kind, predicate.value, predicate.number)
+    if constant is None:
+        return 'False'
+    cell = f"x{predicate.attr}" if kind != 'str' or predicate.operator == '=' else f"float(x{predicate.attr})"
+    values.append(constant)
+    return f"({cell} {operator} v{len(values) - 1})"
+
+
+@lru_cache(maxsize=256)
+def _fused_kernel(expression, positions, nvalues):
+    # Compile one mask function evaluating the whole condition in a single pass
+    # over the rows, instead of one mask per comparison combined afterwards
+    columns = ', '.join(f"c{i}" for i in positions)
+    if len(positions) == 1:
+        loop = f"for x{positions[0]} in c{positions[0]}"
+    else:
+        loop = f"for {', '.join(f'x{i}' for i in positions)} in zip({columns})"
+    unpack = f"    {', '.join(f'v{k}' for k in range(nvalues))}, = values\n" if nvalues else ''
+    source = f"def kernel({columns}, values):\n{unpack}    return [{expression} {loop}]\n"
+    namespace = {}
+    exec(compile(source, '<fused filter>', 'exec'), {'float': float, 'str': str, 'zip': zip}, namespace)
+    return namespace['kernel']
+
+
+def _like(template, values):
+    # Build a column of the same storage type as `template` from an iterable;
+    # for a DictColumn template the values are codes into its dictionary
+    if isinstance(template, array):
+        return array(template.typecode, values)
+    if isinstance(template, DictColumn):
+        return DictColumn(array('i', values), template.dictionary, template.index)
+    return list(values)
+
+
+def _compress(column, mask):
+    # Keep only the cells whose mask entry is true, preserving the column type;
+    # encoded columns only move their codes
+    if isinstance(column, DictColumn):
+        return _like(column, compress(column.codes, mask))
+    return _like(column, compress(column, mask))
+
+
+def _repeat_each(column, times):
+    # [a, b] -> [a, a, b, b] for times=2, built without a Python-level row loop
+    cells = column.codes if isinstance(column, DictColumn) else column
+    return _like(column, chain.from_iterable(map(repeat, cells, repeat(times, len(column)))))
+
+
+def _tile(column, times):
+    # [a, b] -> [a, b, a, b] for times=2; list and array repetition run in C
+    return column * times
+
+
+def _take(column, indices):
+    # Gather the cells at the given row indices, preserving the column type
+    cells = column.codes if isinstance(column, DictColumn) else column
+    return _like(column, map(cells.__getitem__, indices))
+
+
+def _slice(column, start, stop):
+    # Cells start..stop of a column, preserving the column type
+    if isinstance(column, DictColumn):
+        return DictColumn(column.codes[start:stop], column.dictionary, column.index)
+    return column[start:stop]
+
+
+def _concat_columns(columns):
+    # Join the pieces of one column, e.g. the blocks of a blocked cross product
+    template = columns[0]
+    if isinstance(template, DictColumn) and all(column.dictionary is template.dictionary for column in columns):
+        return _like(template, chain.from_iterable(column.codes for column in columns))
+    if isinstance(template, array) and all(_kind(column) == template.typecode for column in columns):
+        return _like(template, chain.from_iterable(columns))
+    return list(chain.from_iterable(columns))
+
+
+def _unify(left, right):
+    # Bring two columns to comparable cells for hashing whole rows: encoded
+    # columns are compared by code, with the right codes remapped into a
+    # dictionary shared with the left; returns (left cells, right cells, template).
+    # The same text can be typed in one relation and not in another ('79' next
+    # to '079'), so columns of different kinds are compared as text
+    if isinstance(left, DictColumn) and isinstance(right, DictColumn):
+        if left.dictionary is right.dictionary:
+            return left.codes, right.codes, left
+        merged = _dictionary_encode(right.dictionary, list(left.dictionary), dict(left.index))
+        return left.codes, array('i', map(merged.codes.__getitem__, right.codes)), merged
+    if isinstance(left, array) and isinstance(right, array) and left.typecode == right.typecode:
+        return left, right, left
+    return list(map(str, left)), list(map(str, right)), []
+
+
+def _concat(template, left, right):
+    return _like(template, chain(left, right))
+
+
+def _attribute_index(attributes):
+    # attribute -> column index; a duplicated name (from a cross product) maps
+    # to its first occurrence, like list.index did
+    index = {}
+    for i, attr in enumerate(attributes):
+        index.setdefault(attr, i)
+    return index
+
+
+def _make_relation(attributes, columns, nrows=None):
+    if nrows is None:
+        nrows = len(columns[0]) if columns else 0
+    return {'attributes': list(attributes), 'columns': list(columns), 'nrows': nrows,
+            'attr_idx': _attribute_index(attributes)}
+
+
+def _cross(left_relation, right_relation):
+    # Cross product column by column: every left row is repeated once per
+    # right row, and the right relation is tiled once per left row
+    left_rows, right_rows = left_relation['nrows'], right_relation['nrows']
+    combined_columns = [_repeat_each(column, right_rows) for column in left_relation['columns']]
+    combined_columns += [_tile(column, left_rows) for column in right_relation['columns']]
+    combined_attributes = left_relation['attributes'] + right_relation['attributes']
+    return _make_relation(combined_attributes, combined_columns, left_rows * right_rows)
+
+
+def _concat_relations(relations):
+    # Stack relations with the same attributes, like the blocks of one result
+    if len(relations) == 1:
+        return relations[0]
+    columns = [_concat_columns([relation['columns'][i] for relation in relations])
+               for i in range(len(relations[0]['columns']))]
+    return _make_relation(relations[0]['attributes'], columns, sum(relation['nrows'] for relation in relations))
+
+
+def _iter_rows(relation):
+    return zip(*relation['columns'])
+
+
+# Rows handed to the CSV writer at a time when streaming query results
+ROW_BATCH_SIZE = 65536
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Total size of the rendered result blocks kept while processing a query file,
+# so a query repeated later in the file is written again without running it
+RENDERED_CACHE_SIZE = 16 << 20
+
+
+def _batched(rows, size=ROW_BATCH_SIZE):
+    # Split a row iterator into lists of at most `size` rows
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _ast_node(name, fields):
+    # namedtuple that compares and hashes together with its type: plain
+    # namedtuples are equal whenever their fields are, so Union(a, b) == Diff(a, b)
+    # and And(terms) == Or(terms) would share an entry in the result cache
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not __eq__(self, other)
+
+    def __hash__(self):
+        return hash((name, tuple(self)))
+
+    return type(name, (namedtuple(name, fields),),
+                {'__slots__': (), '__eq__': __eq__, '__ne__': __ne__, '__hash__': __hash__})
+
+
+# Query AST built by parse_query. Conditions are trees of And/Or terms over
+# Comparison leaves; `quoted` tells a string literal from a bare name, which
+# may refer to another attribute, and `number` is the literal read as a float
+# (None when it is not numeric), so no comparison has to parse it again.
+Relation = _ast_node('Relation', ['name'])
+Select = _ast_node('Select', ['condition', 'child'])
+Project = _ast_node('Project', ['attributes', 'child'])
+Cross = _ast_node('Cross', ['left', 'right'])
+Union = _ast_node('Union', ['left', 'right'])
+Diff = _ast_node('Diff', ['left', 'right'])
+# L |X| R: equi-join on every attribute name the two sides share. A theta
+# join L JOIN_{condition} R is parsed as SELE_{condition} (L * R), which the
+# planner runs as a hash join when the condition equates the two sides.
+NaturalJoin = _ast_node('NaturalJoin', ['left', 'right'])
+And = _ast_node('And', ['terms'])
+Or = _ast_node('Or', ['terms'])
+Comparison = _ast_node('Comparison', ['attr', 'operator', 'value', 'quoted', 'number'])
+# Comparison of two columns, produced when binding a condition to a relation
+ColumnComparison = _ast_node('ColumnComparison', ['left', 'operator', 'right'])
+
+# Query plan nodes built by SimpleDB.optimize. Predicates are condition trees
+# bound to column positions; JoinStep.on holds (left column, right column)
+# pairs of an equi-join, empty for a cross product.
+ScanStep = namedtuple('ScanStep', ['source', 'columns', 'predicate'])
+JoinStep = namedtuple('JoinStep', ['left', 'right', 'on'])
+FilterStep = namedtuple('FilterStep', ['child', 'predicate'])
+ProjectStep = namedtuple('ProjectStep', ['child', 'columns', 'attributes'])
+
+QUERY_TOKEN = re.compile(r"""\s*(?:
+    (?P<operator>SELE|PROJ)_?\s*\{(?P<args>[^}]*)\}
+  | (?P<join>JOIN)_?\s*\{(?P<on>[^}]*)\}
+  | (?P<paren>[()])
+  | (?P<binary>\|X\||[*\-]|[UX](?![\w.]))
+  | (?P<name>[A-Za-z_][\w.]*)
+)""", re.VERBOSE)
+
+CONDITION_TOKEN = re.compile(r"""\s*(?:
+    (?P<string>'[^']*'|"[^"]*"|[\u2018\u2019][^\u2018\u2019]*[\u2018\u2019])
+  | (?P<number>-?\d+(?:\.\d*)?|-?\.\d+)
+  | (?P<operator>[<>!]=|[<>=])
+  | (?P<paren>[(),])
+  | (?P<name>[A-Za-z_][\w.]*)
+)""", re.VERBOSE)
+
+
+def _project_node(args, child):
+    attributes = tuple(attr.strip() for attr in args.split(','))
+    if not all(attributes):
+        raise ValueError(f"Invalid attribute list '{args}'.")
+    return Project(attributes, child)
+
+
+# Operator keyword -> node constructor; the tokenizer has already classified the query
+UNARY_NODES = {
+    'SELE': lambda args, child: Select(parse_condition(args), child),
+    'PROJ': _project_node,
+}
+BINARY_NODES = {'*': Cross, 'X': Cross, 'U': Union, '-': Diff, '|X|': NaturalJoin}
+# Token kind of an operator whose last group holds its arguments
+ARGUMENT_KINDS = {'args': 'operator', 'on': 'join'}
+
+
+def _tokenize(pattern, text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = pattern.match(text, position)
+        if match is None or match.end() == position:
+            raise ValueError(f"Unexpected input at '{text[position:]}'.")
+        tokens.append((ARGUMENT_KINDS.get(match.lastgroup, match.lastgroup), match))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    # Recursive descent over a token list; `kind` and `value` peek at the current token
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def kind(self):
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def value(self):
+        return self.tokens[self.position][1].group(self.kind()) if self.kind() else None
+
+    def advance(self):
+        match = self.tokens[self.position][1]
+        self.position += 1
+        return match
+
+    def expect(self, kind, value):
+        if self.kind() != kind or self.value() != value:
+            raise ValueError(f"Expected '{value}' but found '{self.value() or 'end of query'}'.")
+        self.advance()
+
+    def done(self):
+        if self.position != len(self.tokens):
+            raise ValueError(f"Unexpected '{self.value()}'.")
+
+    # expression := operand (('*' | 'X' | 'U' | '-' | '|X|' | JOIN_{condition}) operand)*, left associative
+    def expression(self):
+        node = self.operand()
+        while self.kind() in ('binary', 'join'):
+            if self.kind() == 'join':
+                condition = parse_condition(self.advance().group('on').strip())
+                node = Select(condition, Cross(node, self.operand()))
+                continue
+            node_type = BINARY_NODES[self.advance().group('binary')]
+            node = node_type(node, self.operand())
+        return node
+
+    # operand := SELE_{condition} operand | PROJ_{attributes} operand | '(' expression ')' | name
+    def operand(self):
+        kind = self.kind()
+        if kind == 'operator':
+            match = self.advance()
+            build = UNARY_NODES[match.group('operator')]
+            return build(match.group('args').strip(), self.operand())
+        if kind == 'paren' and self.value() == '(':
+            self.advance()
+            node = self.expression()
+            self.expect('paren', ')')
+            return node
+        if kind == 'name':
+            return Relation(self.advance().group('name'))
+        raise ValueError(f"Expected a relation but found '{self.value() or 'end of query'}'.")
+
+    # condition := conjunction (OR conjunction)*
+    def condition(self):
+        terms = [self.conjunction()]
+        while self.kind() == 'name' and self.value() == 'OR':
+            self.advance()
+            terms.append(self.conjunction())
+        return terms[0] if len(terms) == 1 else Or(tuple(terms))
+
+    # conjunction := atom ((AND | ',') atom)*
+    def conjunction(self):
+        terms = [self.atom()]
+        while (self.kind(), self.value()) in (('name', 'AND'), ('paren', ',')):
+            self.advance()
+            terms.append(self.atom())
+        return terms[0] if len(terms) == 1 else And(tuple(terms))
+
+    # atom := '(' condition ')' | name operator (string | number | name)
+    def atom(self):
+        if self.kind() == 'paren' and self.value() == '(':
+            self.advance()
+            node = self.condition()
+            self.expect('paren', ')')
+            return node
+        if self.kind() != 'name':
+            raise ValueError(f"Expected an attribute but found '{self.value() or 'end of condition'}'.")
+        attr = self.advance().group('name')
+        if self.kind() != 'operator':
+            raise ValueError(f"Expected an operator after '{attr}'.")
+        operator = self.advance().group('operator')
+        if operator not in OPS:
+            raise ValueError(f"Unsupported operator '{operator}' in condition.")
+        kind = self.kind()
+        if kind not in ('string', 'number', 'name'):
+            raise ValueError(f"Expected a value after '{attr} {operator}'.")
+        value = self.advance().group(kind)
+        if kind == 'string':
+            value = value[1:-1]
+        return Comparison(attr, operator, value, kind == 'string', _parse_number(value))
+
+
+def _parse_number(text):
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=256)
+def parse_query(query):
+    # Parse a relational algebra query once into its AST; repeated query strings hit the cache
+    parser = _Parser(_tokenize(QUERY_TOKEN, query))
+    node = parser.expression()
+    parser.done()
+    return node
+
+
+@lru_cache(maxsize=256)
+def parse_condition(condition):
+    parser = _Parser(_tokenize(CONDITION_TOKEN, condition))
+    node = parser.condition()
+    parser.done()
+    return node
+
+
+def _leaves(condition):
+    # Comparisons of a condition tree, in order
+    if isinstance(condition, (And, Or)):
+        for term in condition.terms:
+            yield from _leaves(term)
+    else:
+        yield condition
+
+
+def _conjuncts(condition):
+    # Flatten nested ANDs into the list of terms that must all hold
+    if isinstance(condition, And):
+        return [conjunct for term in condition.terms for conjunct in _conjuncts(term)]
+    return [condition]
+
+
+def _implied_filter(disjunction, is_local):
+    # Condition on one join input implied by an OR spanning both inputs: the OR
+    # of each disjunct's terms local to that input, so (a=1 AND x=2) OR (a=3 AND x=4)
+    # implies a=1 OR a=3 on the side of a. None if some disjunct has no local term.
+    disjuncts = []
+    for disjunct in disjunction.terms:
+        part = []
+        for term in _conjuncts(disjunct):
+            implied = term if is_local(term) else _implied_filter(term, is_local) if type(term) is Or else None
+            if implied is not None:
+                part.append(implied)
+        if not part:
+            return None
+        disjuncts.append(part[0] if len(part) == 1 else And(tuple(part)))
+    return Or(tuple(disjuncts))
+
+
+def _bind(condition, resolve):
+    # Replace attribute names in a condition tree by column positions; a bare
+    # (unquoted) value naming an attribute compares two columns
+    if isinstance(condition, (And, Or)):
+        return type(condition)(tuple(_bind(term, resolve) for term in condition.terms))
+    position = resolve(condition.attr)
+    if position is None:
+        raise ValueError(f"Attribute '{condition.attr}' not found.")
+    if not condition.quoted:
+        other = resolve(condition.value)
+        if other is not None:
+            return ColumnComparison(position, condition.operator, other)
+    return condition._replace(attr=position)
+
+
+def _attribute_position(attr_idx, attr):
+    # Column index of an attribute; a qualified name (PAY.ANO) also matches its bare form
+    index = attr_idx.get(attr)
+    if index is None and '.' in attr:
+        index = attr_idx.get(attr.split('.', 1)[1])
+    return index
+
+
+def _resolve_attribute(sides, attr):
+    # Find (side, column index) of an attribute over [(attributes, sources), ...],
+    # where `sources` names the base relation every column comes from. A qualified
+    # name (PAY.ANO) picks the column of that relation, through subqueries and
+    # nested products too, and otherwise matches as written or by its bare form
+    # like _attribute_position; names bind to the first side that has them, like
+    # the header of a cross product does, with a warning if another side has them too.
+    names = [attr]
+    if '.' in attr:
+        relation_name, bare = attr.split('.', 1)
+        for side, (attributes, sources) in enumerate(sides):
+            for index, (name, source) in enumerate(zip(attributes, sources)):
+                if name == bare and source == relation_name:
+                    return side, index
+        names.append(bare)
+    for name in names:
+        for side, (attributes, _) in enumerate(sides):
+            if name in attributes:
+                if any(name in other for other, _ in sides[side + 1:]):
+                    _warn_ambiguous(attr, tuple(tuple(attributes) for attributes, _ in sides))
+                return side, attributes.index(name)
+    return None
+
+
+@lru_cache(maxsize=None)
+def _warn_ambiguous(attr, attributes):
+    # Log an ambiguous name once per query (SimpleDB.write_query_result clears
+    # this), although planning resolves it several times
+    logger.warning("Attribute '%s' is ambiguous in %s; using the first, qualify it with its relation name.",
+                   attr, ' * '.join(f"({', '.join(side)})" for side in attributes))
+
+
+# Relation cache files written by convert_csv_dir_to_cache: a JSON header line
+# followed by raw array bytes, so loading one never runs code from the file
+CACHE_SUFFIX = '.rel'
+CACHE_VERSION = 1
+CACHE_TYPECODES = {'q', 'd', 'i'}
+
+# Largest block of a cross product (in rows) materialized at once. Larger
+# products are evaluated block by block, with the filter and projection above
+# them applied to every block
+CROSS_PRODUCT_LIMIT = 10_000_000
+
+
+# Upper bound on the threads used to read relation files concurrently
+MAX_READ_WORKERS = 16
+
+
+def _read_file(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def _read_csv_relation(path, needed=None):
+    return _parse_csv_relation(_read_file(path), needed)
+
+
+def _parse_csv_relation(data, needed=None):
+    # Decode like open(path, 'r') would, then parse the CSV text; with a set of
+    # needed attributes, the other columns are dropped before being typed
+    with io.TextIOWrapper(io.BytesIO(data)) as file:
+        reader = csv.reader(file)
+        attributes = next(reader)  # first row is attributes
+        rows = [row for row in reader if row]  # remaining rows are data
+    if needed is not None:
+        keep = [i for i, attr in enumerate(attributes) if attr in needed]
+        attributes = [attributes[i] for i in keep]
+        rows_kept = len(rows)
+        rows = list(map(itemgetter(*keep), rows)) if len(keep) > 1 else [[row[i] for i in keep] for row in rows]
+        if not keep:
+            return _make_relation(attributes, [], rows_kept)
+    # Transpose into one typed column per attribute
+    columns = [_infer_column(values) for values in zip(*rows)] if rows else [[] for _ in attributes]
+    return _make_relation(attributes, columns, len(rows))
+
+
+def _prune_relation(relation, needed):
+    # Keep only the needed attributes of an already loaded relation
+    keep = [i for i, attr in enumerate(relation['attributes']) if attr in needed]
+    return _make_relation([relation['attributes'][i] for i in keep], [relation['columns'][i] for i in keep],
+                          relation['nrows'])
+
+
+def _scan_needed_columns(query_file):
+    # Pre-scan a query file for the attributes each relation has to provide:
+    # relation name -> set of attribute names, or None when all are needed.
+    # Names cannot be tied to a relation before loading, so every relation
+    # under a projection keeps each name the projection and its conditions use.
+    needed = {}
+
+    def walk(node, required):
+        node_type = type(node)
+        if node_type is Relation:
+            if required is None or needed.get(node.name, set()) is None:
+                needed[node.name] = None
+            else:
+                needed.setdefault(node.name, set()).update(required)
+        elif node_type is Project:
+            walk(node.child, {attr.split('.', 1)[-1] for attr in node.attributes})
+        elif node_type is Select:
+            if required is not None:
+                required = set(required)
+                for leaf in _leaves(node.condition):
+                    required.add(leaf.attr.split('.', 1)[-1])
+                    if not leaf.quoted and leaf.number is None:
+                        required.add(leaf.value.split('.', 1)[-1])  # may name another attribute
+            walk(node.child, required)
+        elif node_type is Cross:
+            walk(node.left, required)
+            walk(node.right, required)
+        else:
+            # Set operations compare whole rows, and a natural join's keys are
+            # only known from the loaded headers: their inputs keep every column
+            walk(node.left, None)
+            walk(node.right, None)
+
+    with open(query_file, 'r') as f:
+        for query in f:
+            query = query.strip()
+            try:
+                node = parse_query(query) if query else None
+            except ValueError:
+                continue  # reported when the query is processed
+            if node is not None:
+                walk(node, None)
+    return needed
+
+
+def _source_stat(path):
+    # What a cache records of its CSV to tell when the CSV has changed since
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _dump_relation(relation, source=None):
+    # Header: attributes, row count, the stat of the source CSV and one layout
+    # per column; text is stored in the header, arrays as bytes after it
+    layouts, arrays = [], []
+    for column in relation['columns']:
+        if isinstance(column, DictColumn):
+            layout, cells = {'kind': 'dict', 'dictionary': column.dictionary}, column.codes
+        elif isinstance(column, array):
+            layout, cells = {'kind': 'array'}, column
+        else:
+            layouts.append({'kind': 'str', 'values': list(column)})
+            continue
+        layout.update(typecode=cells.typecode, itemsize=cells.itemsize, count=len(cells))
+        layouts.append(layout)
+        arrays.append(cells)
+    header = {'version': CACHE_VERSION, 'byteorder': sys.byteorder, 'attributes': relation['attributes'],
+              'nrows': relation['nrows'], 'source': source, 'columns': layouts}
+    return b''.join([json.dumps(header).encode('utf-8'), b'\n'] + [cells.tobytes() for cells in arrays])
+
+
+def _load_relation(data):
+    # Inverse of _dump_relation: the relation and the source stat it records
+    end = data.index(b'\n')
+    header = json.loads(data[:end])
+    if header.get('version') != CACHE_VERSION:
+        raise ValueError(f"Unsupported cache version {header.get('version')!r}.")
+    data, offset = memoryview(data), end + 1
+    columns = []
+    for layout in header['columns']:
+        if layout['kind'] == 'str':
+            columns.append(layout['values'])
+            continue
+        if layout['typecode'] not in CACHE_TYPECODES:
+            raise ValueError(f"Unsupported column type {layout['typecode']!r} in cache.")
+        cells = array(layout['typecode'])
+        if cells.itemsize != layout['itemsize']:
+            raise ValueError("Cache was written on a platform with other array sizes.")
+        size = layout['count'] * cells.itemsize
+        cells.frombytes(data[offset:offset + size])
+        offset += size
+        if header['byteorder'] != sys.byteorder:
+            cells.byteswap()
+        columns.append(DictColumn(cells, layout['dictionary']) if layout['kind'] == 'dict' else cells)
+    return _make_relation(header['attributes'], columns, header['nrows']), header['source']
+
+
+def convert_csv_dir_to_cache(src, dst):
+    # One-time conversion: parse every CSV once and store the typed columns,
+    # so later runs skip tokenizing and type inference entirely
+    os.makedirs(dst, exist_ok=True)
+    for filename in os.listdir(src):
+        if filename.endswith('.csv'):
+            csv_path = os.path.join(src, filename)
+            relation = _read_csv_relation(csv_path)
+            with open(os.path.join(dst, filename[:-4] + CACHE_SUFFIX), 'wb') as file:
+                file.write(_dump_relation(relation, _source_stat(csv_path)))
 
 
 class SimpleDB:
     def __init__(self):
         self.relations = {}
+        self.cross_product_limit = CROSS_PRODUCT_LIMIT
+        # Query node type -> evaluator, built once instead of a type ladder per node
+        self.DISPATCH = {
+            Relation: lambda node: self.get_relation_data(node.name),
+            Select: self.evaluate_select,
+            Project: self.evaluate_project,
+            Cross: lambda node: self.execute_plan(self.optimize(node)),
+            Union: self.evaluate_union,
+            Diff: self.evaluate_diff,
+            NaturalJoin: self.evaluate_natural_join,
+        }
+        # Results of evaluated subqueries keyed on their AST (and node type), so a
+        # subquery repeated within a query is evaluated only once. The cache is
+        # emptied after every query, keeping peak memory at one query's results
+        self._evaluate_cached = lru_cache(maxsize=128)(self._evaluate)
 
-    def load_relations(self, directory):
-        for filename in os.listdir(directory):
+    def load_relations(self, directory, needed=None, use_cache=False):
+        # `needed` (from _scan_needed_columns) limits loading to the relations
+        # and attributes the queries use; None loads everything. With use_cache,
+        # cache files from convert_csv_dir_to_cache are read instead of their CSVs
+        filenames = os.listdir(directory)
+        paths = {}
+        for filename in filenames:
+            if use_cache and filename.endswith(CACHE_SUFFIX):
+                relation_name = filename[:-len(CACHE_SUFFIX)]
+                if needed is not None and relation_name not in needed:
+                    continue
+                paths[relation_name] = os.path.join(directory, filename)
+
+        for filename in filenames:
             if filename.endswith('.csv'):
                 relation_name = filename[:-4]  # remove .csv
-                with open(os.path.join(directory, filename), 'r') as file:
-                    reader = csv.reader(file)
-                    attributes = next(reader)  # first row is attributes
-                    data = [row for row in reader]  # remaining rows are data
-                    self.relations[relation_name] = {'attributes': attributes, 'data': data}
+                if needed is not None and relation_name not in needed:
+                    continue
+                paths.setdefault(relation_name, os.path.join(directory, filename))  # fall back to CSV for new files
+
+        if not paths:
+            return
+        # Read all files concurrently: file reads release the GIL, so the opens
+        # and reads of every relation overlap instead of running one after another
+        with ThreadPoolExecutor(max_workers=min(MAX_READ_WORKERS, len(paths))) as pool:
+            contents = pool.map(_read_file, paths.values())
+            for (relation_name, path), data in zip(paths.items(), contents):
+                columns = needed.get(relation_name) if needed is not None else None
+                if path.endswith(CACHE_SUFFIX):
+                    relation, source = _load_relation(data)
+                    csv_path = os.path.join(directory, relation_name + '.csv')
+                    if os.path.exists(csv_path) and _source_stat(csv_path) != source:
+                        # The CSV changed after the conversion and wins over its stale cache
+                        relation = _read_csv_relation(csv_path, columns)
+                    elif columns is not None:
+                        relation = _prune_relation(relation, columns)
+                    self.relations[relation_name] = relation
+                else:
+                    self.relations[relation_name] = _parse_csv_relation(data, columns)
+        self._evaluate_cached.cache_clear()  # cached results refer to the old relations
 
-    def process_queries_from_file(self, query_file, output_file):
+    def process_queries_from_file(self, query_file, output_file, workers=None):
         with open(query_file, 'r') as f:
-            queries = f.readlines()
+            queries = [query.strip() for query in f]
 
-        results = []
-        for query in queries:
-            query = query.strip()
-            try:
-                if query.startswith("SELE"):
-                    result = self.selection(query)
-                elif query.startswith("PROJ"):
-                    result = self.projection(query)
-                elif query.startswith("X"):
-                    result = self.crossproduct(query)
-                elif query.startswith("JOIN"):
-                    result = self.join(query)
-                elif query.startswith("*"):
-                    result = self.naturaljoin(query)
-                elif query.startswith("U"):
-                    result = self.union(query)
-                elif query.startswith("-"):
-                    result = self.difference(query)
-                elif query.startswith(","):
-                    result = self.AND(query)
-                elif query.startswith("OR"):
-                    result = self.OR(query)
-                else:
-                    result = None
-
-                results.append((query, result))
-                # Debug: Print each query result
-                print(f"Query: {query}")
-                print(f"Result: {result}")
-
-            except Exception as e:
-                results.append((query, f"Error: {str(e)}"))
-                print(f"Error processing query '{query}': {str(e)}")
-
-        # Write results to output file
-        with open(output_file, 'w', newline='') as out_file:
-            writer = csv.writer(out_file)
-            for query, result in results:
-                writer.writerow([query])
-                if isinstance(result, list):
-                    writer.writerows(result)
-                writer.writerow([])  # blank line between queries
+        # A large file buffer, filled by one write per query block or row batch
+        with open(output_file, 'w', newline='', buffering=OUTPUT_BUFFER_SIZE) as out_file:
+            if not workers or workers <= 1:
+                # Write each result as soon as it is computed, so only one result is
+                # held in memory at a time, besides the small blocks kept for
+                # repeated query text
+                rendered, kept = {}, 0
+                for query in queries:
+                    block = rendered.get(query)
+                    if block is not None:
+                        out_file.write(block)
+                        continue
+                    block = self.write_query_result(out_file, query)
+                    if block is not None and kept + len(block) <= RENDERED_CACHE_SIZE:
+                        rendered[query] = block
+                        kept += len(block)
+                return
+
+            # Queries are independent: run them in worker processes (no GIL
+            # contention) that load one snapshot of the relations, and write the
+            # rendered results back in query order
+            with tempfile.TemporaryDirectory() as tmp:
+                snapshot = os.path.join(tmp, 'relations.pickle')  # private to this run
+                with open(snapshot, 'wb') as file:
+                    pickle.dump(self.relations, file, protocol=pickle.HIGHEST_PROTOCOL)
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                         initargs=(snapshot, self.cross_product_limit)) as pool:
+                    for block in pool.map(_run_one, queries):
+                        out_file.write(block)
+
+    def write_query_result(self, out_file, query):
+        # Rows are formatted into an in-memory buffer and handed to the file
+        # whenever it holds OUTPUT_BUFFER_SIZE, instead of one write call per
+        # row. Returns the whole block if it never had to be flushed early
+        buffer = io.StringIO(newline='')
+        writer = csv.writer(buffer)
+        writer.writerow([query])
+        flushed = False
+        try:
+            if query:
+                attributes, batches = self.execute_query(query)
+                logger.debug("Query: %s", query)
+                writer.writerow(attributes)
+                rows = 0
+                for batch in batches:
+                    writer.writerows(batch)
+                    rows += len(batch)
+                    if buffer.tell() >= OUTPUT_BUFFER_SIZE:
+                        out_file.write(buffer.getvalue())
+                        buffer.seek(0)
+                        buffer.truncate()
+                        flushed = True
+                logger.debug("Result: %d rows", rows)
+
+        except Exception as e:
+            logger.warning("Error processing query '%s': %s", query, e)
+        finally:
+            self._evaluate_cached.cache_clear()
+            _warn_ambiguous.cache_clear()
+        writer.writerow([])  # blank line between queries
+        block = buffer.getvalue()
+        out_file.write(block)
+        return None if flushed else block
+
+    def execute_query(self, query):
+        # Evaluate one query into its attributes and an iterator of row batches;
+        # only its subqueries go through the result cache
+        node = parse_query(query)
+        if type(node) is Cross:
+            # A top-level cross product is streamed row by row, never materialized;
+            # its inputs are planned, so a nested product on the left is read
+            # block by block as well
+            plan = self.optimize(node)
+            right_rows = list(_iter_rows(self.execute_plan(plan.right)))
+            left_rows = chain.from_iterable(map(_iter_rows, self.execute_blocks(plan.left, ROW_BATCH_SIZE)))
+            rows = (left_row + right_row for left_row in left_rows for right_row in right_rows)
+            return self.attributes_of(node), _batched(rows)
+        relation = self._evaluate(type(node), node)
+        return relation['attributes'], _batched(_iter_rows(relation))
+
+    def dispatch(self, node):
+        if type(node) is Relation:
+            return self.get_relation_data(node.name)  # base relations need no cache entry
+        return self._evaluate_cached(type(node), node)
+
+    def _evaluate(self, node_type, node):
+        evaluate = self.DISPATCH.get(node_type)
+        if evaluate is None:
+            raise ValueError(f"Unknown query node {node!r}.")
+        return evaluate(node)
+
+    def attributes_of(self, node):
+        # Output attributes of a query node, without evaluating it
+        node_type = type(node)
+        if node_type is Relation:
+            return self.get_relation_data(node.name)['attributes']
+        elif node_type is Project:
+            return list(node.attributes)
+        elif node_type is Cross:
+            return self.attributes_of(node.left) + self.attributes_of(node.right)
+        elif node_type is NaturalJoin:
+            left = self.attributes_of(node.left)
+            return left + [attr for attr in self.attributes_of(node.right) if attr not in left]
+        elif node_type in (Select, Union, Diff):
+            return self.attributes_of(node.child if node_type is Select else node.left)
+        raise ValueError(f"Unknown query node {node!r}.")
+
+    def sources_of(self, node):
+        # Base relation of every output column of a query node, in the order of
+        # attributes_of (None for a column it cannot be traced to)
+        node_type = type(node)
+        if node_type is Relation:
+            return [node.name] * len(self.attributes_of(node))
+        elif node_type is Project:
+            sides = [(self.attributes_of(node.child), self.sources_of(node.child))]
+            found = [_resolve_attribute(sides, attr) for attr in node.attributes]
+            return [sides[0][1][index[1]] if index is not None else None for index in found]
+        elif node_type is Cross:
+            return self.sources_of(node.left) + self.sources_of(node.right)
+        elif node_type is NaturalJoin:
+            left = self.attributes_of(node.left)
+            right = zip(self.attributes_of(node.right), self.sources_of(node.right))
+            return self.sources_of(node.left) + [source for attr, source in right if attr not in left]
+        elif node_type in (Select, Union, Diff):
+            return self.sources_of(node.child if node_type is Select else node.left)
+        raise ValueError(f"Unknown query node {node!r}.")
+
+    def plannable(self, node):
+        # PROJ / SELE chains over a cross product go through the planner
+        if type(node) is Project:
+            node = node.child
+        while type(node) is Select:
+            node = node.child
+        return type(node) is Cross
 
     def selection(self, query):
-        # Extract relation and condition
-        relation_name = query.split('(')[-1].split(')')[0].strip()
-        condition = query.split('{')[1].split('}')[0].strip()
+        return self.dispatch(parse_query(query))
 
-        # Find the relation
-        if relation_name not in self.relations:
-            raise ValueError(f"Relation '{relation_name}' not found.")
+    def evaluate_select(self, node):
+        # Selections over a cross product are planned so the filters are pushed below it
+        if self.plannable(node):
+            return self.execute_plan(self.optimize(node))
 
-        data = self.relations[relation_name]["data"]
-        conditions = self.parse_conditions(condition)
-
-        # Evaluate condition
-        filtered_data = [
-            row for row in data if self.evaluate_conditions(row, conditions)
-        ]
-        return [self.relations[relation_name]["attributes"]] + filtered_data  # Include header
-
-    def parse_conditions(self, condition_str):
-        # Split conditions based on AND/OR
-        conditions = []
-        if 'AND' in condition_str:
-            conditions.extend(cond.strip() for cond in condition_str.split('AND'))
-        elif 'OR' in condition_str:
-            conditions.extend(cond.strip() for cond in condition_str.split('OR'))
-        else:
-            conditions.append(condition_str)
-        return conditions
+        relation = self.dispatch(node.child)
+        attributes = relation['attributes']
+        predicate = _bind(node.condition, lambda attr: _attribute_position(relation['attr_idx'], attr))
 
-    def evaluate_conditions(self, row, conditions):
-        results = []
-        for condition in conditions:
-            if condition:  # Ignore empty conditions
-                attr, operator, value = condition.split()
-                value = value.strip("'")
+        # Evaluate the condition over whole columns, then keep the matching cells of every column
+        mask = self.condition_mask(relation, predicate)
+        columns = [_compress(column, mask) for column in relation['columns']]
+        return _make_relation(attributes, columns, sum(mask))
 
-                # Find the index of the attribute
-                col_index = self.get_attribute_index(attr)
+    def condition_mask(self, relation, predicate):
+        # Mask of the rows satisfying a bound condition tree. A single comparison
+        # uses the per-type kernel; anything larger runs as one fused kernel
+        columns = relation['columns']
+        if isinstance(predicate, Comparison):
+            return self.predicate_mask(columns[predicate.attr], predicate.operator, predicate.value, predicate.number)
 
-                # Evaluate the condition for this row
-                results.append(self.evaluate_condition(row[col_index], operator, value))
+        positions = set()
+        for leaf in _leaves(predicate):
+            positions.update((leaf.left, leaf.right) if isinstance(leaf, ColumnComparison) else (leaf.attr,))
+        positions = tuple(sorted(positions))
+        # Encoded columns are scanned as codes, unless compared with another
+        # column whose dictionary differs; then they are decoded
+        decoded = {position for leaf in _leaves(predicate) if isinstance(leaf, ColumnComparison)
+                   for position in (leaf.left, leaf.right)}
+        cells = {i: ColumnCodes(columns[i]) if isinstance(columns[i], DictColumn) and i not in decoded else columns[i]
+                 for i in positions}
+        values = []
+        expression = _fused_expression(predicate, cells, values)
+        kernel = _fused_kernel(expression, positions, len(values))
+        scanned = (cell.column.codes if isinstance(cell, ColumnCodes) else cell for cell in cells.values())
+        return kernel(*scanned, values)
 
-        # Return True if all conditions are True for AND, or if any are True for OR
-        return all(results)  # For AND conditions
+    def predicate_mask(self, column, operator, value, number=None):
+        # Dispatch on the column type to a cached kernel that makes one C-level
+        # pass over the column; numeric columns were typed at load, and the
+        # constant was read as a number at parse time
+        if number is None:
+            number = _parse_number(value)
+        return _comparison_kernel(operator, _kind(column))(column, value, number)
 
     def projection(self, query):
-        # Extract the relation and attributes to project
-        relation_query = query.split('(')[-1].split(')')[0].strip()
-        attributes = query.split('{')[1].split('}')[0].strip().split(',')
-        attributes = [attr.strip() for attr in attributes]
-
-        # If the relation involves a cross product (e.g., ACTORS * PAY), handle that first
-        if '*' in relation_query:
-            relation_data = self.crossproduct(f"{relation_query}")
-            rel_attributes = relation_data[0]  # First row is the header (attributes)
-            data = relation_data[1:]  # Remaining rows are the actual data
-        else:
-            # Otherwise, it's a single relation
-            relation_name = relation_query.strip()
-            if relation_name not in self.relations:
-                raise ValueError(f"Relation '{relation_name}' not found.")
+        return self.dispatch(parse_query(query))
 
-            rel_attributes = self.relations[relation_name]["attributes"]
-            data = self.relations[relation_name]["data"]
+    def evaluate_project(self, node):
+        # If the relation involves a cross product (e.g., ACTORS * PAY), plan it so
+        # only the projected columns are carried through the product
+        if self.plannable(node):
+            return self.execute_plan(self.optimize(node))
+
+        # PROJ over SELE is fused: the mask is computed once and only the
+        # projected columns are compressed, the filtered relation never exists
+        source, condition = node.child, None
+        if type(source) is Select:
+            source, condition = source.child, source.condition
+        relation = self.dispatch(source)
 
         # Validate and get the indices of the attributes to project
         col_indices = []
-        for attr in attributes:
-            if attr not in rel_attributes:
-                raise ValueError(f"Attribute '{attr}' not found in relation '{relation_query}'.")
-            col_indices.append(rel_attributes.index(attr))
+        for attr in node.attributes:
+            index = _attribute_position(relation['attr_idx'], attr)
+            if index is None:
+                raise ValueError(f"Attribute '{attr}' not found in relation.")
+            col_indices.append(index)
 
-        # Project the required columns
-        projected_data = [[row[i] for i in col_indices] for row in data]
-        return [attributes] + projected_data  # Include the attributes as the header
+        columns = [relation['columns'][i] for i in col_indices]
+        if condition is None:
+            # Projecting only picks columns, no row is touched
+            return _make_relation(node.attributes, columns, relation['nrows'])
+        predicate = _bind(condition, lambda attr: _attribute_position(relation['attr_idx'], attr))
+        mask = self.condition_mask(relation, predicate)
+        return _make_relation(node.attributes, [_compress(column, mask) for column in columns], sum(mask))
 
     def crossproduct(self, query):
-        # Extract relation names
-        relations = query.split('(')[-1].split(')')[0].strip().split('*')
-        if len(relations) != 2:
-            raise ValueError("Cross product requires exactly two relations.")
+        return self.dispatch(parse_query(query))
+
+    def cross(self, left_relation, right_relation):
+        # Materialize a whole cross product (a natural join without shared attributes)
+        return _cross(left_relation, right_relation)
+
+    def cross_blocks(self, left_relation, right_relation, size=None):
+        # Cross product as consecutive blocks of at most `size` rows (by default
+        # cross_product_limit, but at least one left row each), for products
+        # too large to build whole
+        size = size or self.cross_product_limit
+        if left_relation['nrows'] * right_relation['nrows'] <= size:
+            yield _cross(left_relation, right_relation)
+            return
+        step = max(1, size // right_relation['nrows'])
+        for start in range(0, left_relation['nrows'], step):
+            block = _make_relation(left_relation['attributes'],
+                                   [_slice(column, start, start + step) for column in left_relation['columns']],
+                                   min(step, left_relation['nrows'] - start))
+            yield _cross(block, right_relation)
+
+    def transfer_predicates(self, left_relation, right_relation, on):
+        # Semi-join both inputs on their join keys before the hash join: rows
+        # whose key cannot appear on the other side are dropped up front, so
+        # the filters already applied to one side also shrink the other
+        for source, target in ((0, 1), (1, 0)):
+            relations = [left_relation, right_relation]
+            keys = self.join_keys(left_relation, right_relation, on)
+            mask = list(map(set(keys[source]).__contains__, keys[target]))
+            if not all(mask):
+                relation = relations[target]
+                relations[target] = _make_relation(relation['attributes'],
+                                                   [_compress(column, mask) for column in relation['columns']],
+                                                   sum(mask))
+            left_relation, right_relation = relations
+        return left_relation, right_relation
+
+    def join_keys(self, left_relation, right_relation, on):
+        # Key columns of both sides; composite keys become tuples. Encoded
+        # columns are decoded, the two sides have their own dictionaries, and
+        # a key typed on one side only ('79' next to 79) is compared as text
+        sides = ([], [])
+        for pair in on:
+            columns = [relation['columns'][i] for relation, i in zip((left_relation, right_relation), pair)]
+            columns = [list(column) if isinstance(column, DictColumn) else column for column in columns]
+            if len(set(map(_kind, columns))) > 1:
+                columns = [list(map(str, column)) for column in columns]
+            for keys, column in zip(sides, columns):
+                keys.append(column)
+        if len(on) == 1:
+            return sides[0][0], sides[1][0]
+        return list(zip(*sides[0])), list(zip(*sides[1]))
 
-        left_relation = self.get_relation_data(relations[0].strip())
-        right_relation = self.get_relation_data(relations[1].strip())
+    def hash_join(self, left_relation, right_relation, on):
+        # Build a key -> row indices table on the smaller side and probe it with the larger one
+        left_keys, right_keys = self.join_keys(left_relation, right_relation, on)
 
-        # Perform cross product
-        combined_data = [left_row + right_row for left_row in left_relation['data'] for right_row in right_relation['data']]
+        build_left = left_relation['nrows'] <= right_relation['nrows']
+        build_keys, probe_keys = (left_keys, right_keys) if build_left else (right_keys, left_keys)
+        table = defaultdict(list)
+        for i, key in enumerate(build_keys):
+            table[key].append(i)
+
+        build_indices, probe_indices = [], []
+        for j, key in enumerate(probe_keys):
+            matches = table.get(key)
+            if matches:
+                build_indices.extend(matches)
+                probe_indices.extend(repeat(j, len(matches)))
+        left_indices, right_indices = (build_indices, probe_indices) if build_left else (probe_indices, build_indices)
+
+        combined_columns = [_take(column, left_indices) for column in left_relation['columns']]
+        combined_columns += [_take(column, right_indices) for column in right_relation['columns']]
         combined_attributes = left_relation['attributes'] + right_relation['attributes']
-        return [combined_attributes] + combined_data  # Include header
+        return _make_relation(combined_attributes, combined_columns, len(left_indices))
+
+    def join(self, query):
+        return self.dispatch(parse_query(query))
+
+    def naturaljoin(self, query):
+        return self.dispatch(parse_query(query))
+
+    def evaluate_natural_join(self, node):
+        left_relation = self.dispatch(node.left)
+        right_relation = self.dispatch(node.right)
+
+        # Join on every shared attribute; without one it is a cross product
+        on = [(left_relation['attr_idx'][attr], j) for j, attr in enumerate(right_relation['attributes'])
+              if attr in left_relation['attr_idx']]
+        if not on:
+            return self.cross(left_relation, right_relation)
+        joined = self.hash_join(*self.transfer_predicates(left_relation, right_relation, on), on)
+
+        # The right copies of the join attributes are dropped from the output
+        offset = len(left_relation['attributes'])
+        dropped = {offset + j for _, j in on}
+        keep = [i for i in range(len(joined['attributes'])) if i not in dropped]
+        return _make_relation([joined['attributes'][i] for i in keep], [joined['columns'][i] for i in keep],
+                              joined['nrows'])
+
+    def optimize(self, node):
+        # Plan PROJ_{...} (SELE_{...} (L * R)) (PROJ and SELE both optional) as
+        # ProjectStep(FilterStep(JoinStep(ScanStep(L), ScanStep(R)))): conditions that touch one side
+        # and all column pruning are pushed into the scans, and an attribute
+        # equality across the two sides turns the cross product into a hash join.
+        attributes = None
+        if type(node) is Project:
+            attributes, node = node.attributes, node.child
+        terms = []
+        while type(node) is Select:
+            terms += _conjuncts(node.condition)
+            node = node.child
+
+        children = (node.left, node.right)
+        sides = [(self.attributes_of(child), self.sources_of(child)) for child in children]
+
+        def resolve(attr):
+            found = _resolve_attribute(sides, attr)
+            if found is None:
+                raise ValueError(f"Attribute '{attr}' not found in relation.")
+            return found
+
+        def references(term):
+            # (side, index) of every column a condition term reads
+            found = []
+            for leaf in _leaves(term):
+                found.append(resolve(leaf.attr))
+                other = None if leaf.quoted else _resolve_attribute(sides, leaf.value)
+                if other is not None:
+                    found.append(other)
+            return found
+
+        # Classify every condition term as local to one side, a join key, or post-join
+        local = ([], [])
+        on, post = [], []
+        for term in terms:
+            columns = references(term)
+            touched = {side for side, _ in columns}
+            if len(touched) == 1:
+                local[touched.pop()].append(term)
+            elif type(term) is Comparison and term.operator == '=':
+                on.append(tuple(sorted(columns)))
+            else:
+                post.append(term)
+
+        # Join-dependent predicate duplication: an OR over both sides stays
+        # post-join, but the filter it implies on each side is also pushed into
+        # that side's scan, so fewer rows reach the join
+        for term in post:
+            if type(term) is Or:
+                for side in (0, 1):
+                    implied = _implied_filter(term, lambda t: {s for s, _ in references(t)} == {side})
+                    if implied is not None:
+                        local[side].append(implied)
+
+        # Columns every side has to carry: projected, post-join filtered, or join keys
+        needed = (set(), set())
+        if attributes is None:
+            for side, child in enumerate(children):
+                needed[side].update(range(len(self.attributes_of(child))))
+        else:
+            for attr in attributes:
+                side, index = resolve(attr)
+                needed[side].add(index)
+        for side, index in chain.from_iterable(map(references, post)):
+            needed[side].add(index)
+        for pair in on:
+            for side, index in pair:
+                needed[side].add(index)
+
+        # Positions of the carried columns in the joined output
+        scan_columns = [sorted(columns) for columns in needed]
+        position = {}
+        for side, columns in enumerate(scan_columns):
+            offset = len(scan_columns[0]) if side else 0
+            position.update(((side, index), offset + k) for k, index in enumerate(columns))
+
+        scans = []
+        for side, child in enumerate(children):
+            def resolve_local(attr, side=side):
+                found = _resolve_attribute(sides, attr)
+                return found[1] if found is not None and found[0] == side else None
+            if type(child) is Cross:
+                # A nested product is planned itself, with its conditions as a
+                # selection, so it is hash joined or evaluated in blocks too
+                if local[side]:
+                    child = Select(And(tuple(local[side])), child)
+                scans.append(ProjectStep(self.optimize(child), scan_columns[side],
+                                         [sides[side][0][i] for i in scan_columns[side]]))
+                continue
+            predicate = _bind(And(tuple(local[side])), resolve_local) if local[side] else None
+            scans.append(ScanStep(child, scan_columns[side], predicate))
+
+        plan = JoinStep(scans[0], scans[1], [(position[l], position[r] - len(scan_columns[0])) for l, r in on])
+        if post:
+            def found_position(attr):
+                return position.get(_resolve_attribute(sides, attr))
+            plan = FilterStep(plan, _bind(And(tuple(post)), found_position))
+        if attributes is not None:
+            plan = ProjectStep(plan, [position[resolve(attr)] for attr in attributes], list(attributes))
+        return plan
+
+    def execute_plan(self, node):
+        if isinstance(node, ScanStep):
+            relation = self.dispatch(node.source)
+            columns = [relation['columns'][i] for i in node.columns]
+            attributes = [relation['attributes'][i] for i in node.columns]
+            if node.predicate is None:
+                return _make_relation(attributes, columns, relation['nrows'])
+            # Only the carried columns are compressed
+            mask = self.condition_mask(relation, node.predicate)
+            return _make_relation(attributes, [_compress(column, mask) for column in columns], sum(mask))
+        if isinstance(node, JoinStep) and node.on:
+            left, right = self.execute_plan(node.left), self.execute_plan(node.right)
+            return self.hash_join(*self.transfer_predicates(left, right, node.on), node.on)
+        if isinstance(node, (JoinStep, FilterStep, ProjectStep)):
+            return _concat_relations(list(self.execute_blocks(node)))
+        raise ValueError(f"Unknown plan node {node!r}.")
+
+    def execute_blocks(self, node, size=None):
+        # Evaluate a plan as a sequence of row blocks: a cross product above the
+        # limit (or `size`) is built block by block, and the filter and
+        # projection above it run on every block, so only the rows that survive
+        # them are kept. The left input of a product is itself consumed block by
+        # block; the right one is tiled against every left row, so it is whole
+        if isinstance(node, JoinStep) and not node.on:
+            right = self.execute_plan(node.right)
+            for left in self.execute_blocks(node.left, size):
+                yield from self.cross_blocks(left, right, size)
+        elif isinstance(node, FilterStep):
+            for relation in self.execute_blocks(node.child, size):
+                mask = self.condition_mask(relation, node.predicate)
+                yield _make_relation(relation['attributes'],
+                                     [_compress(column, mask) for column in relation['columns']], sum(mask))
+        elif isinstance(node, ProjectStep):
+            for relation in self.execute_blocks(node.child, size):
+                yield _make_relation(node.attributes, [relation['columns'][i] for i in node.columns],
+                                     relation['nrows'])
+        else:
+            yield self.execute_plan(node)
 
     def union(self, query):
-        # Extract the two relations to union
-        relations = query.split('(')[-1].split(')')[0].strip().split('U')
-        if len(relations) != 2:
-            raise ValueError("Union requires exactly two relations.")
+        return self.dispatch(parse_query(query))
 
-        left_relation = self.get_relation_data(relations[0].strip())
-        right_relation = self.get_relation_data(relations[1].strip())
+    def evaluate_union(self, node):
+        left_relation = self.dispatch(node.left)
+        right_relation = self.dispatch(node.right)
 
         # Ensure both relations have the same attributes
         if left_relation['attributes'] != right_relation['attributes']:
             raise ValueError("Union requires both relations to have the same attributes.")
 
-        # Combine data
-        combined_data = left_relation['data'] + right_relation['data']
-        # Remove duplicates
-        combined_data = list(map(list, set(map(tuple, combined_data))))  # Remove duplicates
-        return [left_relation['attributes']] + combined_data
+        # Combine data column by column; encoded columns are hashed as codes of a shared dictionary
+        columns = [_concat(template, left, right) for left, right, template in
+                   map(_unify, left_relation['columns'], right_relation['columns'])]
+
+        # Remove duplicates in one C-level pass: dict keys keep the rows in
+        # first-occurrence order, and each maps to a row index holding it
+        distinct = dict(zip(zip(*(column.codes if isinstance(column, DictColumn) else column for column in columns)),
+                            count()))
+        indices = list(distinct.values())
+        return _make_relation(left_relation['attributes'], [_take(column, indices) for column in columns], len(indices))
 
     def evaluate_query(self, query):
         query = query.strip()
         try:
-            if query.startswith("SELE"):
-                return self.selection(query)
-            elif query.startswith("PROJ"):
-                return self.projection(query)
-            elif query.startswith("X"):
-                return self.crossproduct(query)
-            elif query.startswith("JOIN"):
-                return self.join(query)
-            elif query.startswith("*"):
-                return self.naturaljoin(query)
-            elif query.startswith("U"):
-                return self.union(query)
-            elif query.startswith("-"):
-                return self.difference(query)
-            else:
-                return None
+            return self.dispatch(parse_query(query))
         except Exception as e:
-            print(f"Error evaluating query '{query}': {str(e)}")
+            logger.warning("Error evaluating query '%s': %s", query, e)
             return None
 
     def difference(self, query):
-        # Extract the subqueries for the difference
-        subqueries = query.split(') - (')
-        if len(subqueries) != 2:
-            raise ValueError("Invalid difference query format")
-
-        left_query = subqueries[0].strip() + ')'
-        right_query = '(' + subqueries[1].strip()
+        return self.dispatch(parse_query(query))
 
+    def evaluate_diff(self, node):
         # Evaluate both subqueries
-        left_relation = self.evaluate_query(left_query)
-        right_relation = self.evaluate_query(right_query)
+        left_relation = self.dispatch(node.left)
+        right_relation = self.dispatch(node.right)
 
-        # Debug: Print the two relations for comparison
-        print(f"Left query: {left_query}")
-        print(f"Left relation result: {left_relation}")
-        print(f"Right query: {right_query}")
-        print(f"Right relation result: {right_relation}")
+        # The relations are only formatted when debug output is enabled;
+        # stringifying a large table costs far more than the difference itself
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("Left query: %s", node.left)
+            logger.debug("Left relation result: %s", left_relation)
+            logger.debug("Right query: %s", node.right)
+            logger.debug("Right relation result: %s", right_relation)
 
         # Check if both relations have the same number of columns
-        if not left_relation or not right_relation:
-            print("One of the subqueries returned no results.")
-            return None
-
-        if len(left_relation[0]) != len(right_relation[0]):
+        if len(left_relation['attributes']) != len(right_relation['attributes']):
             raise ValueError("The two relations must have the same number of columns for the difference operation.")
 
-        # Perform set difference (rows in left_relation but not in right_relation)
-        left_data = [tuple(row) for row in left_relation[1:]]  # Exclude header
-        right_data = [tuple(row) for row in right_relation[1:]]  # Exclude header
+        if debug:
+            logger.debug("Left data tuples: %s", list(_iter_rows(left_relation)))
+            logger.debug("Right data tuples: %s", list(_iter_rows(right_relation)))
 
-        # Debug: Print the tuples being compared
-        print(f"Left data tuples: {left_data}")
-        print(f"Right data tuples: {right_data}")
+        # Perform set difference as an anti-join: distinct left rows (in order)
+        # whose row is not in the hashed right relation; encoded columns are
+        # hashed as codes, with the right side remapped to the left dictionary
+        unified = list(map(_unify, left_relation['columns'], right_relation['columns']))
+        right_rows = set(zip(*(right for _, right, _ in unified)))
+        distinct = dict(zip(zip(*(left for left, _, _ in unified)), count()))
+        indices = list(compress(distinct.values(), map(not_, map(right_rows.__contains__, distinct))))
+        result = _make_relation(left_relation['attributes'],
+                                [_take(column, indices) for column in left_relation['columns']], len(indices))
 
-        difference_data = list(set(left_data) - set(right_data))
+        if debug:
+            logger.debug("Difference result: %s", list(_iter_rows(result)))
 
-        # Debug: Print the final difference result
-        print(f"Difference result: {difference_data}")
-
-        # Return result with headers
-        if difference_data:
-            return [left_relation[0]] + [list(row) for row in difference_data]
-        else:
-            return [left_relation[0]]  # Return header only if no difference found
+        # Return result with headers (header only if no difference found)
+        return result
 
     def get_relation_data(self, relation_name):
         # Find the relation
@@ -247,25 +1436,31 @@ class SimpleDB:
             raise ValueError(f"Relation '{relation_name}' not found.")
         return self.relations[relation_name]
 
-    def get_attribute_index(self, attr):
-        # Check each relation for the attribute
-        for relation in self.relations.values():
-            if attr in relation['attributes']:
-                return relation['attributes'].index(attr)
-        raise ValueError(f"Attribute '{attr}' not found in any relation.")
 
-    def evaluate_condition(self, value, operator, condition_value):
-        # Handle basic operators
-        if operator == '>':
-            return float(value) > float(condition_value)
-        elif operator == '<':
-            return float(value) < float(condition_value)
-        elif operator == '=':
-            return value == condition_value
-        return False
+# Query worker processes: each holds its own copy of the database, loaded once
+_worker_db = None
+
+
+def _init_worker(snapshot, cross_product_limit):
+    global _worker_db
+    _worker_db = SimpleDB()
+    _worker_db.cross_product_limit = cross_product_limit
+    with open(snapshot, 'rb') as file:
+        _worker_db.relations = pickle.load(file)
+
+
+def _run_one(query):
+    # Render one query's result as CSV text for the parent to write out
+    buffer = io.StringIO(newline='')
+    _worker_db.write_query_result(buffer, query)
+    return buffer.getvalue()
 
 
 # Example usage
-db = SimpleDB()
-db.load_relations(r'Data')  # Directory containing your CSV files
-db.process_queries_from_file(r'C:\Project 1\RAqueries.txt', r'C:\Project 1\RAoutput.csv')
+if __name__ == '__main__':  # guarded so worker processes can import this module
+    logging.basicConfig(level=logging.WARNING)  # use logging.DEBUG to trace every query
+    query_file = r'C:\Project 1\RAqueries.txt'
+    db = SimpleDB()
+    # Directory containing your CSV files; only the columns the queries use are loaded
+    db.load_relations(r'Data', needed=_scan_needed_columns(query_file))
+    db.process_queries_from_file(query_file, r'C:\Project 1\RAoutput.csv')
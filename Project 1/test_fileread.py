@@ -0,0 +1,426 @@
+import csv
+import io
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from decimal import Decimal
+
+from Fileread import (CACHE_SUFFIX, And, Cross, Diff, NaturalJoin, Or, Project, Relation, Select,
+                      SimpleDB, Union, _infer_column, _scan_needed_columns, convert_csv_dir_to_cache,
+                      parse_query)
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data')
+
+
+def run_batch_blocks(db, queries, workers=None):
+    # Run queries through process_queries_from_file and read back each query's
+    # block: the query, its header and its rows (only the query on an error)
+    with tempfile.TemporaryDirectory() as tmp:
+        query_file, output_file = os.path.join(tmp, 'queries.txt'), os.path.join(tmp, 'output.csv')
+        with open(query_file, 'w') as f:
+            f.write('\n'.join(queries) + '\n')
+        db.process_queries_from_file(query_file, output_file, workers)
+        with open(output_file, newline='') as f:
+            lines = list(csv.reader(f))
+    # Blocks are separated by a blank line
+    blocks, block = [], []
+    for line in lines:
+        if line:
+            block.append(line)
+        else:
+            blocks.append(block)
+            block = []
+    return blocks
+
+
+def run_batch(db, queries):
+    return [block[2:] for block in run_batch_blocks(db, queries)]
+
+
+def load_reference(directory):
+    # Relations as the baseline held them: header and rows of raw CSV text
+    relations = {}
+    for filename in os.listdir(directory):
+        if filename.endswith('.csv'):
+            with open(os.path.join(directory, filename), newline='') as f:
+                rows = [row for row in csv.reader(f) if row]
+            relations[filename[:-4]] = (rows[0], [filename[:-4]] * len(rows[0]), rows[1:])
+    return relations
+
+
+def reference_position(attributes, sources, attr):
+    # Column of an attribute: PAY.ANO is the ANO column coming from PAY, a bare
+    # name is its first occurrence
+    if '.' in attr:
+        relation_name, bare = attr.split('.', 1)
+        for i, (name, source) in enumerate(zip(attributes, sources)):
+            if name == bare and source == relation_name:
+                return i
+        if attr not in attributes:
+            attr = bare
+    return attributes.index(attr) if attr in attributes else None
+
+
+def reference_holds(condition, attributes, sources, row):
+    # Row-wise condition semantics of the baseline: '=' compares text, '<' and
+    # '>' compare as numbers (exactly, so integers past 2**53 stay apart); an
+    # unquoted name that is an attribute means its cell
+    if type(condition) is And:
+        return all(reference_holds(term, attributes, sources, row) for term in condition.terms)
+    if type(condition) is Or:
+        return any(reference_holds(term, attributes, sources, row) for term in condition.terms)
+    cell = row[reference_position(attributes, sources, condition.attr)]
+    other = None if condition.quoted else reference_position(attributes, sources, condition.value)
+    value = condition.value if other is None else row[other]
+    if condition.operator == '=':
+        return cell == value
+    return Decimal(cell) > Decimal(value) if condition.operator == '>' else Decimal(cell) < Decimal(value)
+
+
+def reference(relations, node):
+    # Naive nested-loop evaluation of a query AST into (attributes, sources, rows)
+    node_type = type(node)
+    if node_type is Relation:
+        return relations[node.name]
+    if node_type is Select:
+        attributes, sources, rows = reference(relations, node.child)
+        return attributes, sources, [row for row in rows if reference_holds(node.condition, attributes, sources, row)]
+    if node_type is Project:
+        attributes, sources, rows = reference(relations, node.child)
+        columns = [reference_position(attributes, sources, attr) for attr in node.attributes]
+        return list(node.attributes), [sources[i] for i in columns], [[row[i] for i in columns] for row in rows]
+    left_attributes, left_sources, left_rows = reference(relations, node.left)
+    right_attributes, right_sources, right_rows = reference(relations, node.right)
+    if node_type is Cross:
+        return (left_attributes + right_attributes, left_sources + right_sources,
+                [left + right for left in left_rows for right in right_rows])
+    if node_type is NaturalJoin:
+        shared = [(left_attributes.index(attr), j) for j, attr in enumerate(right_attributes)
+                  if attr in left_attributes]
+        keep = [j for j, attr in enumerate(right_attributes) if attr not in left_attributes]
+        rows = [left + [right[j] for j in keep] for left in left_rows for right in right_rows
+                if all(left[i] == right[j] for i, j in shared)]
+        attributes = left_attributes + [right_attributes[j] for j in keep]
+        return attributes, left_sources + [right_sources[j] for j in keep], rows
+    distinct = []
+    for row in left_rows + (right_rows if node_type is Union else []):
+        if row not in distinct and (node_type is not Diff or row not in right_rows):
+            distinct.append(row)
+    return left_attributes, left_sources, distinct
+
+
+class ReferenceTest(unittest.TestCase):
+    # Every query is checked against the naive reference, all of them in one
+    # batch so results of different operators over the same operands meet
+    QUERIES = [
+        # Multi-term conditions on dictionary-encoded columns (ANO and MNO of PAY)
+        "SELE_{ANO = 'A2' AND MNO = 'M3'} (PAY)",
+        "SELE_{ANO = 'A2' OR MNO = 'M1' AND Payment > 90} (PAY)",
+        "SELE_{(ANO = 'A4' OR ANO = 'A6') AND (MNO = 'M2' OR Payment < 56)} (PAY)",
+        "SELE_{ANO = MNO OR MNO = 'M4' AND ANO = 'A5'} (PAY)",
+        "SELE_{ANO = 'A9' OR MNO = 'M9'} (PAY)",
+        'PROJ_{MNO} (SELE_{Payment > 80 AND Payment < 97} (PAY))',
+        'SELE_{Payment = 79.0} (PAY)',
+        'SELE_{Payment = 79 OR Payment = 079} (PAY)',
+        # Qualified names over subqueries and nested products
+        "SELE_{PAY.ANO = ACTORS.ANO AND MNO = 'M3'} ((SELE_{Payment > 90} (PAY)) * ACTORS)",
+        'PROJ_{ANAME, MNAME} (SELE_{ACTORS.ANO = PAY.ANO AND PAY.MNO = MOVIES.MNO} '
+        '((PROJ_{ANO, ANAME} (ACTORS)) * PAY * MOVIES))',
+        'PROJ_{ANAME, PAY.MNO} (SELE_{PAY.MNO = MOVIES.MNO AND ACTORS.ANO = PAY.ANO AND Payment > 90} '
+        '(ACTORS * (PAY * MOVIES)))',
+        "PROJ_{ANAME, Payment} (SELE_{(ANAME = 'J Grass' AND Payment < 80) OR (ANAME = 'L Hills' AND MNO = 'M3')} "
+        '(ACTORS * PAY))',
+        # Joins, set operations and plain products
+        'ACTORS JOIN_{ACTORS.ANO = PAY.ANO AND Payment > 95} PAY',
+        'ACTORS |X| PAY',
+        'PROJ_{ANO} (ACTORS |X| PAY)',
+        'PROJ_{ANO} (ACTORS * PAY)',
+        '(PROJ_{ANO} (ACTORS)) - (PROJ_{ANO} (SELE_{Payment > 90} (PAY)))',
+        '(PROJ_{ANO} (ACTORS)) U (PROJ_{ANO} (SELE_{Payment > 90} (PAY)))',
+        '(PROJ_{ANO} (PAY)) U (PROJ_{ANO} (ACTORS))',
+        'PROJ_{ANO} (ACTORS) * PROJ_{MNO} (MOVIES)',
+    ]
+
+    # Relations whose columns hold the same text under different kinds: R.ID
+    # is typed as integers, S.ID stays text because of '079'
+    MIXED = {
+        'R': 'ID\n79\n80\n',
+        'S': 'ID\n079\n79\n80\n',
+        # X stays text because of '02', Y is typed as integers
+        'XY': 'X,Y\n9,10\n02,3\n5,5\n',
+        # T.ID stays text because of its empty cell, R.ID is typed as integers
+        'T': 'ID,NAME\n79,a\n,b\n80,c\n081,d\n',
+        # Integers that the same float stands for
+        'BIG': 'ID\n1234567890123456789\n1234567890123456788\n',
+        # P is dictionary-encoded, and 'N/A' is only held by rows where K is not 'a'
+        'Q': 'K,P\na,7\na,5\nb,N/A\nb,N/A\na,7\nb,N/A\na,5\nb,N/A\n',
+    }
+    MIXED_QUERIES = [
+        '(PROJ_{ID} (R)) U (PROJ_{ID} (S))',
+        '(PROJ_{ID} (R)) - (PROJ_{ID} (S))',
+        '(PROJ_{ID} (S)) - (PROJ_{ID} (R))',
+        'SELE_{X < Y} (XY)',
+        'SELE_{X > Y} (XY)',
+        'SELE_{X = Y} (XY)',
+        'SELE_{X = Y OR X > Y} (XY)',
+        'R |X| T',
+        'R JOIN_{R.ID = T.ID} T',
+        'SELE_{R.ID = T.ID} (R * T)',
+        "SELE_{R.ID = T.ID AND NAME = 'c'} (R * T)",
+        'SELE_{ID = 1234567890123456789} (BIG)',
+        "SELE_{ID = '1234567890123456789'} (BIG)",
+        'SELE_{ID > 1234567890123456788} (BIG)',
+        'SELE_{ID < 1234567890123456789} (BIG)',
+        'SELE_{ID > 1234567890123456788.5} (BIG)',
+        # Equality on a typed column still compares text
+        'SELE_{ID = 079} (R)',
+        'SELE_{ID = 79.0} (R)',
+        'SELE_{ID = 79} (S)',
+        'SELE_{ID > 79.5} (R)',
+        "SELE_{P > 6} (SELE_{K = 'a'} (Q))",
+        "SELE_{K = 'a' AND P > 6} (Q)",
+        "SELE_{K = 'a' AND (P < 6 OR K = 'b')} (Q)",
+    ]
+
+    def assert_matches_reference(self, directory, queries):
+        db = SimpleDB()
+        db.load_relations(directory)
+        relations = load_reference(directory)
+        for query, block in zip(queries, run_batch_blocks(db, queries)):
+            with self.subTest(query=query):
+                self.assertGreater(len(block), 1, 'query failed')
+                attributes, _, rows = reference(relations, parse_query(query))
+                self.assertEqual(block[1], attributes)
+                # Joins may produce their rows in another order than nested loops
+                self.assertEqual(sorted(block[2:]), sorted(rows))
+
+    def test_operators_match_reference(self):
+        self.assert_matches_reference(DATA, self.QUERIES)
+
+    def test_pruned_load_matches_full_load(self):
+        # Loading only the columns the batch uses must not change any result
+        with tempfile.TemporaryDirectory() as tmp:
+            query_file = os.path.join(tmp, 'queries.txt')
+            with open(query_file, 'w') as f:
+                f.write('\n'.join(self.QUERIES) + '\n')
+            needed = _scan_needed_columns(query_file)
+        full, pruned = SimpleDB(), SimpleDB()
+        full.load_relations(DATA)
+        pruned.load_relations(DATA, needed=needed)
+        self.assertEqual(run_batch_blocks(pruned, self.QUERIES), run_batch_blocks(full, self.QUERIES))
+
+    def test_pruned_load_keeps_only_needed_columns(self):
+        queries = ['PROJ_{ANO} (PAY)', "PROJ_{MNAME} (SELE_{MNO = 'M1'} (MOVIES))"]
+        with tempfile.TemporaryDirectory() as tmp:
+            query_file = os.path.join(tmp, 'queries.txt')
+            with open(query_file, 'w') as f:
+                f.write('\n'.join(queries) + '\n')
+            needed = _scan_needed_columns(query_file)
+        self.assertEqual(needed, {'PAY': {'ANO'}, 'MOVIES': {'MNAME', 'MNO'}})
+        pruned, full = SimpleDB(), SimpleDB()
+        pruned.load_relations(DATA, needed=needed)
+        full.load_relations(DATA)
+        self.assertEqual(sorted(pruned.relations), ['MOVIES', 'PAY'])
+        self.assertEqual(pruned.relations['PAY']['attributes'], ['ANO'])
+        self.assertEqual(run_batch_blocks(pruned, queries), run_batch_blocks(full, queries))
+
+    def test_workers_match_serial_run(self):
+        db = SimpleDB()
+        db.load_relations(DATA)
+        queries = self.QUERIES + ['NOSUCH', ''] + self.QUERIES[:3]  # an error, an empty line and repeats
+        self.assertEqual(run_batch_blocks(db, queries, workers=2), run_batch_blocks(db, queries))
+
+    def test_mixed_kinds_match_reference(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for name, text in self.MIXED.items():
+            with open(os.path.join(directory, name + '.csv'), 'w', newline='') as f:
+                f.write(text)
+        self.assert_matches_reference(directory, self.MIXED_QUERIES)
+
+
+class MixedOperatorBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.db = SimpleDB()
+        self.db.load_relations(DATA)
+
+    def test_operators_over_same_operands(self):
+        # Union(a, b), Diff(a, b), Cross(a, b) and NaturalJoin(a, b) have equal
+        # fields; each must still get its own result within one batch
+        union, diff, cross, natural = run_batch(self.db, [
+            'PROJ_{ANO}(ACTORS) U PROJ_{ANO}(PAY)',
+            'PROJ_{ANO}(ACTORS) - PROJ_{ANO}(PAY)',
+            'PROJ_{ANO}(ACTORS * PAY)',
+            'PROJ_{ANO}(ACTORS |X| PAY)',
+        ])
+        self.assertEqual(union, [[f'A{i}'] for i in range(1, 7)])
+        self.assertEqual(diff, [])
+        self.assertEqual(len(cross), 96)
+        self.assertEqual(len(natural), 16)
+
+    def test_and_or_over_same_terms(self):
+        conjunction, disjunction = run_batch(self.db, [
+            "PROJ_{ANO} (SELE_{ANO = 'A1' AND Payment > 79} (PAY))",
+            "PROJ_{ANO} (SELE_{ANO = 'A1' OR Payment > 79} (PAY))",
+        ])
+        self.assertEqual(len(conjunction), 1)
+        self.assertEqual(len(disjunction), 9)
+
+    def test_results_are_not_kept_between_queries(self):
+        run_batch(self.db, ['(PROJ_{ANO}(ACTORS)) U (PROJ_{ANO}(PAY))'])
+        self.assertEqual(self.db._evaluate_cached.cache_info().currsize, 0)
+
+    def test_repeated_query_text_runs_once(self):
+        queries = ["SELE_{ANO = 'A1'} (PAY)", 'PROJ_{ANO}(ACTORS * PAY)', "SELE_{ANO = 'A1'} (PAY)"]
+        executed = []
+        execute_query = self.db.execute_query
+        self.db.execute_query = lambda query: executed.append(query) or execute_query(query)
+        first, second, repeated = run_batch_blocks(self.db, queries)
+        self.assertEqual(executed, queries[:2])
+        self.assertEqual(repeated, first)
+        self.assertEqual(len(first), 4)
+
+
+class EncodedColumnTest(unittest.TestCase):
+    def setUp(self):
+        self.db = SimpleDB()
+        self.db.load_relations(DATA)
+
+    def rows(self, query):
+        _, batches = self.db.execute_query(query)
+        return [list(row) for batch in batches for row in batch]
+
+    def test_column_comparison_and_constant_on_same_encoded_column(self):
+        self.assertEqual(self.rows("SELE_{ANO = MNO AND ANO = 'A1'} (PAY)"), [])
+        self.assertEqual(self.rows("SELE_{ANO = MNO OR MNO = 'M1'} (PAY)"), [['A1', 'M1', 79], ['A5', 'M1', 99]])
+
+
+class NumericColumnTest(unittest.TestCase):
+    def setUp(self):
+        self.db = SimpleDB()
+        self.db.load_relations(DATA)
+
+    def rows(self, query):
+        _, batches = self.db.execute_query(query)
+        return [list(row) for batch in batches for row in batch]
+
+    def test_equality_with_text_matches_nothing(self):
+        self.assertEqual(self.rows("SELE_{Payment = 'abc'} (PAY)"), [])
+        self.assertEqual(self.rows("SELE_{Payment = 'abc' OR ANO = 'A1'} (PAY)"), [['A1', 'M1', 79], ['A1', 'M2', 80]])
+        self.assertEqual(self.rows('SELE_{Payment = 70.5} (PAY)'), [])
+
+    def test_ordering_with_text_is_an_error(self):
+        with self.assertRaises(ValueError):
+            self.rows("SELE_{Payment > 'abc'} (PAY)")
+
+
+class QualifiedNameTest(unittest.TestCase):
+    def setUp(self):
+        self.db = SimpleDB()
+        self.db.load_relations(DATA)
+        self.db.cross_product_limit = 50  # larger than any join result, smaller than the products
+
+    def count(self, query):
+        _, batches = self.db.execute_query(query)
+        return sum(map(len, batches))
+
+    def test_qualified_names_over_subquery(self):
+        self.assertEqual(self.count('SELE_{PAY.ANO = ACTORS.ANO} ((SELE_{Payment > 90} (PAY)) * ACTORS)'), 5)
+        self.assertEqual(self.count('PROJ_{ANAME} (SELE_{PAY.ANO = ACTORS.ANO} ((PROJ_{ANO, ANAME} (ACTORS)) * PAY))'),
+                         16)
+
+    def test_ambiguous_names_bind_left_with_a_warning(self):
+        out = io.StringIO(newline='')
+        with self.assertLogs('Fileread', 'WARNING') as logs:
+            self.db.write_query_result(out, "SELE_{ANO = 'A1'} (ACTORS * PAY)")
+            self.db.write_query_result(out, "SELE_{ANO = 'A1'} (ACTORS * PAY)")
+        self.assertEqual(len(logs.output), 2)  # once per query, although planning resolves it repeatedly
+        self.assertIn("'ANO' is ambiguous", logs.output[0])
+        self.assertEqual(self.count("SELE_{ANO = 'A1'} (ACTORS * PAY)"), 16)
+        with self.assertNoLogs('Fileread', 'WARNING'):
+            self.assertEqual(self.count("SELE_{PAY.ANO = 'A1' AND ANAME = 'J Grass'} (ACTORS * PAY)"), 2)
+
+    def test_three_way_join(self):
+        self.assertEqual(self.count('PROJ_{ANAME, MNAME} (SELE_{ACTORS.ANO = PAY.ANO AND PAY.MNO = MOVIES.MNO AND '
+                                    'Payment > 95} (ACTORS * PAY * MOVIES))'), 4)
+        self.assertEqual(self.count('PROJ_{ANAME, MNAME} (SELE_{PAY.MNO = MOVIES.MNO AND ACTORS.ANO = PAY.ANO} '
+                                    '(ACTORS * (PAY * MOVIES)))'), 16)
+
+
+class BlockedCrossProductTest(unittest.TestCase):
+    QUERIES = [
+        'PROJ_{ANO} (SELE_{Payment > 97} (ACTORS * PAY))',
+        'SELE_{Payment > 90 OR ANAME = MNO} (ACTORS * PAY)',
+        'PROJ_{ANAME, MNAME} (ACTORS * MOVIES)',
+        'PROJ_{ANAME} (SELE_{ACTORS.ANO = PAY.ANO} (ACTORS * PAY * MOVIES))',
+        # Nested products without a condition of their own, inside a plan and at the top level
+        'PROJ_{ANO, MNO} (PAY * (PAY * PAY))',
+        'PROJ_{ANAME, Payment} ((ACTORS * PAY) * MOVIES)',
+        '(ACTORS * PAY) * ACTORS',
+        'ACTORS * (MOVIES * PAY)',
+        '(PROJ_{ANO} (ACTORS * MOVIES)) U (PROJ_{ANO} (PAY))',
+    ]
+
+    def test_products_above_the_limit_match_whole_products(self):
+        whole, blocked = SimpleDB(), SimpleDB()
+        whole.load_relations(DATA)
+        blocked.load_relations(DATA)
+        blocked.cross_product_limit = 7  # forces several blocks, and one left row per block for PAY
+        self.assertEqual(run_batch(blocked, self.QUERIES), run_batch(whole, self.QUERIES))
+        self.assertEqual(len(run_batch(blocked, self.QUERIES[:1])[0]), 18)
+        self.assertEqual(len(run_batch(blocked, ['(ACTORS * PAY) * ACTORS'])[0]), 576)
+
+
+class Payload:
+    def __reduce__(self):
+        return exec, ("raise RuntimeError('cache file ran code')",)
+
+
+class RelationCacheTest(unittest.TestCase):
+    QUERIES = ["SELE_{ANO = 'A2'} (PAY)", 'PROJ_{ANAME, MNO} (ACTORS |X| PAY)', 'MOVIES']
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = os.path.join(tmp.name, 'Data')
+        shutil.copytree(DATA, self.directory)
+        convert_csv_dir_to_cache(self.directory, self.directory)
+
+    def load(self, **options):
+        db = SimpleDB()
+        db.load_relations(self.directory, **options)
+        return db
+
+    def test_cache_matches_csv(self):
+        whole = SimpleDB()
+        whole.load_relations(DATA)
+        self.assertEqual(run_batch(self.load(use_cache=True), self.QUERIES), run_batch(whole, self.QUERIES))
+
+    def test_caches_are_opt_in_and_never_unpickled(self):
+        with open(os.path.join(self.directory, 'EVIL' + CACHE_SUFFIX), 'wb') as file:
+            pickle.dump(Payload(), file)
+        self.assertNotIn('EVIL', self.load().relations)
+        with self.assertRaises(ValueError):
+            self.load(use_cache=True)
+
+    def test_changed_csv_wins_over_its_cache(self):
+        with open(os.path.join(self.directory, 'MOVIES.csv'), 'a') as file:
+            file.write('\n"New movie","M5"\n')  # blank rows are skipped
+        self.assertEqual(self.load(use_cache=True).relations['MOVIES']['nrows'], 5)
+
+
+class InferColumnTest(unittest.TestCase):
+    def test_cells_keep_their_source_text(self):
+        for values in (['02134', '10001'], ['1', '2.5'], ['2.50', '3.25'], ['1e3', '2'], ['1_000', '2'],
+                       ['nan', '1.5'], ['-0', '1'], ['+5', '6']):
+            self.assertEqual([str(cell) for cell in _infer_column(values)], values)
+
+    def test_canonical_numbers_are_typed(self):
+        self.assertEqual(_infer_column(['79', '-3']).typecode, 'q')
+        self.assertEqual(_infer_column(['1.5', '0.25']).typecode, 'd')
+
+
+if __name__ == '__main__':
+    unittest.main()